@@ -1,43 +1,276 @@
-import base64
+import asyncio
+import binascii
+import functools
 import hmac
-from urllib import parse
-
+import ssl
+import sys
+import time
 import aiohttp
 
+try:
+    import aiofiles
+except ImportError:
+    aiofiles = None
+
+try:
+    import aiodns
+except ImportError:
+    aiodns = None
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+if orjson is not None:
+    def _json_dumps(obj):
+        # aiohttp expects a str from json_serialize, orjson returns bytes
+        return orjson.dumps(obj).decode('utf-8')
+else:
+    import json as _json
+
+    _json_dumps = _json.dumps
+
 from .store.token_store import TokenStore
 
+# one context shared by every session: certificates are actually verified again
+# and OpenSSL can resume TLS sessions to *.dingtalk.com via session tickets
+_SSL_CTX = ssl.create_default_context()
+
+# content types reported to DingTalk per media type, so the server does not
+# have to sniff application/octet-stream uploads
+MEDIA_CONTENT_TYPES = {
+    'image': 'image/jpeg',
+    'voice': 'audio/amr',
+    'video': 'video/mp4',
+    'file': 'application/octet-stream'
+}
+
+# valid outcomes when executing an official oa task
+_OA_TASK_RESULTS = frozenset(('agree', 'refuse'))
+
+
+# encoded-key memo for get_sign: a process signs with at most a few app secrets,
+# so a tiny capped dict avoids re-encoding the same key on every signature
+_KEY_CACHE = {}
+
+
+def _key_bytes(key):
+    key_bytes = _KEY_CACHE.get(key)
+    if key_bytes is None:
+        if len(_KEY_CACHE) >= 8:
+            _KEY_CACHE.clear()
+        key_bytes = _KEY_CACHE[key] = key.encode('utf-8')
+    return key_bytes
+
 
 def get_sign(data, key):
     """
-    signature for dingtalk request
+    signature for dingtalk request, uses the one-shot hmac.digest fast path.
+    data and key may be passed as bytes to skip the str coercion and encode
     :param data:
     :param key:
     """
-    sign = base64.b64encode(
-        hmac.new(key.encode('utf-8'), str(data).encode('utf-8'), digestmod='SHA256').digest())
-    return str(sign, 'utf-8')
+    key_bytes = _key_bytes(key) if isinstance(key, str) else key
+    data_bytes = data if isinstance(data, (bytes, bytearray)) else str(data).encode('utf-8')
+    return _get_sign_bytes(data_bytes, key_bytes).decode('ascii')
+
+
+def _get_sign_bytes(data_bytes, key_bytes):
+    """
+    bytes-in bytes-out variant of get_sign, binascii.b2a_base64 skips the
+    b64encode wrapper and the decode for callers that consume bytes
+    :param data_bytes:
+    :param key_bytes:
+    """
+    return binascii.b2a_base64(hmac.digest(key_bytes, data_bytes, 'sha256'), newline=False)
+
+
+def make_signer(app_secret):
+    """
+    bind a secret into a signing closure: the key is encoded once and the hot
+    path is a single hmac.digest call on a stable callable, which CPython's
+    adaptive interpreter can inline-cache at the call site
+    :param app_secret: app secret as str or bytes
+    :return: sign(data) -> base64 str
+    """
+    key_bytes = app_secret.encode('utf-8') if isinstance(app_secret, str) else app_secret
+
+    def sign(data):
+        data_bytes = data if isinstance(data, (bytes, bytearray)) else str(data).encode('utf-8')
+        return binascii.b2a_base64(hmac.digest(key_bytes, data_bytes, 'sha256'), newline=False).decode('ascii')
+
+    return sign
+
+
+class DingAPIError(Exception):
+    """
+    error returned by the DingTalk API, exposes code and message so callers can
+    match on them without parsing the exception string
+    """
+    __slots__ = ('code', 'message')
+
+    def __init__(self, code, message):
+        super().__init__(f'{code}: {message}')
+        self.code = code
+        self.message = message
+
+
+class DingHTTPError(Exception):
+    """
+    HTTP-level failure with a non-JSON body, e.g. an HTML 502 page from a load
+    balancer, raised before the JSON parser is ever invoked
+    """
+    __slots__ = ('status', 'body')
+
+    def __init__(self, status, body):
+        super().__init__(f'{status}: {body!r}')
+        self.status = status
+        self.body = body
 
 
 def check_response_error(response, error_code=0, error_msg_key='errmsg'):
-    if response['errcode'] != error_code:
-        raise Exception(f'{response["errcode"]}: {response[error_msg_key]}')
+    code = response.get('errcode', 0)
+    if code != error_code:
+        raise DingAPIError(code, response.get(error_msg_key, ''))
 
 
 def check_new_response_error(response, error_code_key='code', error_msg_key='message'):
-    if response.get(error_code_key) is not None:
-        raise Exception(response[error_msg_key])
+    code = response.get(error_code_key)
+    if code is not None:
+        raise DingAPIError(code, response.get(error_msg_key, ''))
+
+
+def _unwrap_old(response, key='result'):
+    """
+    check a legacy-API response for errors and lift the payload in one call
+    :param response: parsed response dict
+    :param key: payload key
+    :return:
+    """
+    check_response_error(response)
+    return response[key]
+
+
+def _unwrap_new(response, key='result'):
+    """
+    check a new-API response for errors and lift the payload in one call
+    :param response: parsed response dict
+    :param key: payload key
+    :return:
+    """
+    check_new_response_error(response)
+    return response[key]
+
+
+def _compact(d):
+    """
+    drop top-level None values from a payload or params dict: DingTalk ignores
+    null fields anyway, and aiohttp rejects None query parameter values
+    :param d: dict
+    :return:
+    """
+    return {k: v for k, v in d.items() if v is not None}
+
+
+async def _read_json(response):
+    """
+    parse a JSON response body, going through orjson when it is installed:
+    it decodes the raw bytes directly instead of detouring through str
+    :param response: aiohttp response
+    :return:
+    """
+    if response.status >= 400 and 'json' not in (response.content_type or ''):
+        raise DingHTTPError(response.status, (await response.read())[:512])
+    if orjson is not None:
+        return orjson.loads(await response.read())
+    # content_type=None skips the Content-Type regex check; DingTalk sometimes
+    # serves JSON as text/plain
+    return await response.json(content_type=None)
+
+
+def _ttl_cache(ttl):
+    """
+    cache an async DingRequest method result for ttl seconds, keyed by app_key and
+    arguments. a hit skips the HTTP call entirely; entries are dropped when the API
+    reports an error so stale authorization never sticks
+    :param ttl: seconds a cached value stays valid
+    :return:
+    """
+    def decorator(func):
+        cache = {}
+
+        @functools.wraps(func)
+        async def wrapper(self, *args, **kwargs):
+            key = (self.app_key, args, tuple(sorted(kwargs.items())))
+            hit = cache.get(key)
+            now = time.monotonic()
+            if hit is not None and hit[0] > now:
+                return hit[1]
+            try:
+                value = await func(self, *args, **kwargs)
+            except DingAPIError:
+                cache.pop(key, None)
+                raise
+            cache[key] = (now + ttl, value)
+            return value
+
+        return wrapper
+    return decorator
 
 
 def join_url(base_url, *args):
+    """
+    append path segments to base_url by plain concatenation. parse.urljoin silently
+    dropped the base path for segments starting with '/', and re-parsed the URL on
+    every call; direct string building is both correct and cheaper
+    :param base_url:
+    :param args: path segments, with or without a leading '/'
+    :return:
+    """
     if not args:
         return base_url
-    return parse.urljoin(base_url, ''.join(args))
+    return base_url.rstrip('/') + ''.join(p if p.startswith('/') else '/' + p for p in args)
 
 
 class DingRequest(object):
     url_prefix = 'https://oapi.dingtalk.com'
     new_api_url_prefix = 'https://api.dingtalk.com'
 
+    # every endpoint is static, so the full URLs are built once at class
+    # definition time instead of going through join_url on each call
+    _EP = {
+        'gettoken': url_prefix + '/gettoken',
+        'user_get': url_prefix + '/topapi/v2/user/get',
+        'auth_scopes': url_prefix + '/auth/scopes',
+        'department_listsubid': url_prefix + '/topapi/v2/department/listsubid',
+        'department_get': url_prefix + '/topapi/v2/department/get',
+        'user_list': url_prefix + '/topapi/v2/user/list',
+        'media_upload': url_prefix + '/media/upload',
+        'message_asyncsend': url_prefix + '/topapi/message/corpconversation/asyncsend_v2',
+        'user_access_token': new_api_url_prefix + '/v1.0/oauth2/userAccessToken',
+        'oa_schemas': new_api_url_prefix + '/v1.0/workflow/processCentres/schemas',
+        'oa_schema_process_codes': new_api_url_prefix + '/v1.0/workflow/processCentres/schemaNames/processCodes',
+        'oa_instances': new_api_url_prefix + '/v1.0/workflow/processCentres/instances',
+        'oa_instances_batch': new_api_url_prefix + '/v1.0/workflow/processCentres/instances/batch',
+        'oa_tasks': new_api_url_prefix + '/v1.0/workflow/processCentres/tasks',
+        'oa_todo_tasks': new_api_url_prefix + '/v1.0/workflow/processCentres/todoTasks',
+        'oa_tasks_cancel': new_api_url_prefix + '/v1.0/workflow/processCentres/tasks/cancel',
+        'official_forms': new_api_url_prefix + '/v1.0/workflow/forms',
+        'official_form_schemas': new_api_url_prefix + '/v1.0/workflow/forms/schemas/processCodes',
+        'official_forecast': new_api_url_prefix + '/v1.0/workflow/processes/forecast',
+        'official_instances': new_api_url_prefix + '/v1.0/workflow/processInstances',
+        'official_instance_ids_query': new_api_url_prefix + '/v1.0/workflow/processes/instanceIds/query',
+        'official_tasks_redirect': new_api_url_prefix + '/v1.0/workflow/tasks/redirect',
+        'official_spaces_infos': new_api_url_prefix + '/v1.0/workflow/processInstances/spaces/infos/query',
+        'official_comments': new_api_url_prefix + '/v1.0/workflow/processInstances/comments',
+        'official_execute': new_api_url_prefix + '/v1.0/workflow/processInstances/execute',
+        'official_terminate': new_api_url_prefix + '/v1.0/workflow/processInstances/terminate',
+        'official_todo_numbers': new_api_url_prefix + '/v1.0/workflow/processes/todoTasks/numbers',
+        'official_visible_templates': new_api_url_prefix + '/v1.0/workflow/processes/userVisibilities/templates',
+        'official_management_templates': new_api_url_prefix + '/v1.0/workflow/processes/managements/templates'
+    }
+
     def __init__(self, app_key, app_secret):
         """
         set Dingtalk app_key and app_secret
@@ -46,28 +279,168 @@ class DingRequest(object):
         """
         self.app_key = app_key
         self.app_secret = app_secret
+        self._app_secret_bytes = app_secret.encode('utf-8') if isinstance(app_secret, str) else app_secret
+        self._hmac_proto = hmac.new(self._app_secret_bytes, None, 'sha256')
+        self._sign = make_signer(self._app_secret_bytes)
         self.token_store = TokenStore(app_key)
+        self._session = None
+        self._session_loop = None
+        self._token_cache = (None, 0.0)
+        self._token_lock = None
+        self._token_lock_loop = None
+        self._new_api_headers = None
+        self._warmed_up = False
+        # constant for the instance's lifetime, built once instead of per refresh
+        self._token_params = {
+            'appkey': app_key,
+            'appsecret': app_secret
+        }
+
+    def _get_token_lock(self):
+        """
+        get the token refresh lock, rebuilt when the running loop changed, so concurrent
+        callers of an expired token collapse into a single get_token request
+        :return:
+        """
+        loop = asyncio.get_running_loop()
+        if self._token_lock is None or self._token_lock_loop is not loop:
+            self._token_lock = asyncio.Lock()
+            self._token_lock_loop = loop
+        return self._token_lock
+
+    def _set_token(self, token, expires_in):
+        self._token_cache = (token, time.monotonic() + expires_in)
+
+    def _get_session(self):
+        """
+        get the shared ClientSession, create it lazily and rebuild it when the running loop changed,
+        so every request reuses the same connection pool instead of paying a TCP+TLS handshake per call
+        :return:
+        """
+        loop = asyncio.get_running_loop()
+        if self._session is None or self._session.closed or self._session_loop is not loop:
+            # aiodns resolves in the event loop instead of a getaddrinfo thread hop,
+            # but its selector requirement makes it unreliable on Windows
+            resolver = aiohttp.resolver.AsyncResolver() \
+                if aiodns is not None and sys.platform != 'win32' else None
+            self._session = aiohttp.ClientSession(
+                connector=aiohttp.TCPConnector(ssl=_SSL_CTX, limit=100, limit_per_host=32,
+                                               keepalive_timeout=75, enable_cleanup_closed=True,
+                                               use_dns_cache=True, ttl_dns_cache=600,
+                                               resolver=resolver),
+                json_serialize=_json_dumps)
+            self._session_loop = loop
+        return self._session
+
+    async def close(self):
+        """
+        release the shared ClientSession and its connections
+        :return:
+        """
+        if self._session is not None and not self._session.closed:
+            await self._session.close()
+        self._session = None
+        self._session_loop = None
+
+    def sign(self, data):
+        """
+        signature with the app secret, copies a keyed HMAC prototype so the
+        ipad/opad key schedule is computed once per instance instead of per call
+        :param data: str or bytes to sign
+        :return:
+        """
+        h = self._hmac_proto.copy()
+        h.update(data if isinstance(data, bytes) else str(data).encode('utf-8'))
+        return binascii.b2a_base64(h.digest(), newline=False).decode('ascii')
+
+    async def warmup(self):
+        """
+        open a keep-alive connection to api.dingtalk.com ahead of time, so the
+        first real new-API call pays no TCP+TLS handshake. failures are ignored:
+        warmup is purely opportunistic
+        :return:
+        """
+        try:
+            async with self._get_session().head(self.new_api_url_prefix) as response:
+                await response.read()
+        except aiohttp.ClientError:
+            pass
 
     async def refresh_token(self):
         """
         refresh token if it expires
         :return:
         """
-        current_token = self.token_store.get()
-        if not current_token:
-            token = await self.get_token()
+        if self.token_store.get():
+            return
+        async with self._get_token_lock():
+            # double-checked so callers queued behind the first refresh reuse its result
+            if self.token_store.get():
+                return
+            if self._warmed_up:
+                token = await self.get_token()
+            else:
+                # hide the new-API handshake behind the token round trip
+                self._warmed_up = True
+                token, _ = await asyncio.gather(self.get_token(), self.warmup())
             self.token_store.save(token['token'], token['expires_in'])
+            self._set_token(token['token'], token['expires_in'])
 
     async def latest_token(self):
         """
-        get latest token
+        get latest token, served from the in-process cache until 60 seconds before expiry
         :return:
         """
+        token, expiry = self._token_cache
+        if token is not None and time.monotonic() < expiry - 60:
+            return token
         await self.refresh_token()
-        return self.token_store.get()
+        token = self.token_store.get()
+        if token is not None and token != self._token_cache[0]:
+            # token was refreshed through the store by someone else, re-check it in a minute
+            self._token_cache = (token, time.monotonic() + 120)
+        return token
 
-    @staticmethod
-    async def get_response(url, params=None, response_callback=None, **kwargs):
+    async def new_api_headers(self):
+        """
+        auth headers for api.dingtalk.com calls, the dict is rebuilt only when the
+        token changes instead of being allocated on every request. the cached dict
+        is re-assigned, never mutated, so handing it to aiohttp is safe
+        :return:
+        """
+        token = await self.latest_token()
+        headers = self._new_api_headers
+        if headers is None or headers['x-acs-dingtalk-access-token'] != token:
+            headers = self._new_api_headers = {'x-acs-dingtalk-access-token': token}
+        return headers
+
+    async def _request(self, method, url, params=None, json=None, data=None, response_callback=None,
+                       new_api=False, **kwargs):
+        """
+        single dispatcher behind the per-verb helpers: one place owns the shared
+        session, the callback hook, the JSON parse and the new-API auth header
+        :param method: HTTP verb
+        :param url: full endpoint url
+        :param params: query params
+        :param json: json body
+        :param data: form/raw body
+        :param response_callback: response callback function
+        :param new_api: attach the cached x-acs-dingtalk-access-token header
+        :return:
+        """
+        if new_api:
+            token_headers = await self.new_api_headers()
+            extra = kwargs.get('headers')
+            kwargs['headers'] = {**token_headers, **extra} if extra else token_headers
+        if isinstance(json, dict):
+            json = _compact(json)
+        if isinstance(params, dict):
+            params = _compact(params)
+        async with self._get_session().request(method, url, params=params, json=json, data=data,
+                                               **kwargs) as response:
+            return await response_callback(response) if response_callback else await _read_json(response)
+
+    async def get_response(self, url, params=None, response_callback=None, **kwargs):
         """
         get response from server
         :param url: url join with url_prefix
@@ -75,13 +448,9 @@ class DingRequest(object):
         :param response_callback: response callback function
         :return:
         """
-        conn = aiohttp.TCPConnector(ssl=False)
-        async with aiohttp.ClientSession(connector=conn) as session:
-            async with session.get(url, params=params, **kwargs) as response:
-                return await response_callback(response) if response_callback else await response.json()
+        return await self._request('GET', url, params=params, response_callback=response_callback, **kwargs)
 
-    @staticmethod
-    async def post_response(url, json, data=None, response_callback=None, **kwargs):
+    async def post_response(self, url, json, data=None, response_callback=None, **kwargs):
         """
         post response to server, if json is not None, use json, else use data
         :param url: url join with url_prefix
@@ -90,13 +459,9 @@ class DingRequest(object):
         :param response_callback: response callback function
         :return:
         """
-        conn = aiohttp.TCPConnector(ssl=False)
-        async with aiohttp.ClientSession(connector=conn) as session:
-            async with session.post(url, json=json, data=data, **kwargs) as response:
-                return await response_callback(response) if response_callback else await response.json()
+        return await self._request('POST', url, json=json, data=data, response_callback=response_callback, **kwargs)
 
-    @staticmethod
-    async def put_response(url, json, data=None, response_callback=None, **kwargs):
+    async def put_response(self, url, json, data=None, response_callback=None, **kwargs):
         """
         put response to server, if json is not None, use json, else use data
         :param url: url join with url_prefix
@@ -105,13 +470,9 @@ class DingRequest(object):
         :param response_callback: response callback function
         :return:
         """
-        conn = aiohttp.TCPConnector(ssl=False)
-        async with aiohttp.ClientSession(connector=conn) as session:
-            async with session.put(url, json=json, data=data, **kwargs) as response:
-                return await response_callback(response) if response_callback else await response.json()
+        return await self._request('PUT', url, json=json, data=data, response_callback=response_callback, **kwargs)
 
-    @staticmethod
-    async def delete_response(url, params=None, response_callback=None, **kwargs):
+    async def delete_response(self, url, params=None, response_callback=None, **kwargs):
         """
         delete response from server
         :param url: url join with url_prefix
@@ -119,20 +480,14 @@ class DingRequest(object):
         :param response_callback: response callback function
         :return:
         """
-        conn = aiohttp.TCPConnector(ssl=False)
-        async with aiohttp.ClientSession(connector=conn) as session:
-            async with session.delete(url, params=params, **kwargs) as response:
-                return await response_callback(response) if response_callback else await response.json()
+        return await self._request('DELETE', url, params=params, response_callback=response_callback, **kwargs)
 
     async def get_token(self):
         """
         get token from server
         :return:
         """
-        response = await self.get_response(join_url(self.url_prefix, 'gettoken'), {
-            'appkey': self.app_key,
-            'appsecret': self.app_secret
-        })
+        response = await self.get_response(self._EP['gettoken'], self._token_params)
         check_response_error(response)
         return {
             'token': response['access_token'],
@@ -147,14 +502,13 @@ class DingRequest(object):
         :param temp_auth_code: temporary authorization code
         :return: {"expireIn":7200,"accessToken":"xx","refreshToken":"xx"}
         """
-        response = await self.post_response(join_url(self.new_api_url_prefix, 'v1.0/oauth2/userAccessToken'), {
+        response = await self.post_response(self._EP['user_access_token'], {
             "clientSecret": app_secret,
             "clientId": app_key,
             "code": temp_auth_code,
             "grantType": "authorization_code"
         })
-        if response.get('code') is not None:
-            raise Exception(response['message'])
+        check_new_response_error(response)
         return response
 
     async def get_user_info_by_access_token(self, user_access_token, union_id='me'):
@@ -181,22 +535,24 @@ class DingRequest(object):
         :return:
         """
         response = await self.post_response(
-            join_url(self.url_prefix, f'topapi/v2/user/get?access_token={await self.latest_token()}'),
+            self._EP['user_get'],
             {
                 'userid': userid,
                 'language': language
-            }
+            },
+            params={'access_token': await self.latest_token()}
         )
-        check_response_error(response)
-        return response['result']
+        return _unwrap_old(response)
 
+    @_ttl_cache(300)
     async def get_auth_scopes(self):
         """
         get auth scopes
         :return:
         """
         response = await self.get_response(
-            join_url(self.url_prefix, f'auth/scopes?access_token={await self.latest_token()}'))
+            self._EP['auth_scopes'],
+            params={'access_token': await self.latest_token()})
         check_response_error(response)
         return {
             'auth_user_field': response['auth_user_field'],
@@ -210,12 +566,12 @@ class DingRequest(object):
         :return:
         """
         response = await self.post_response(
-            join_url(self.url_prefix, f'topapi/v2/department/listsubid?access_token={await self.latest_token()}'), {
+            self._EP['department_listsubid'], {
                 'dept_id': dept_id
-            })
-        check_response_error(response)
-        return response['result']['dept_id_list']
+            }, params={'access_token': await self.latest_token()})
+        return _unwrap_old(response)['dept_id_list']
 
+    @_ttl_cache(60)
     async def department_detail(self, dept_id, language='zh_CN'):
         """
         get department detail
@@ -223,14 +579,14 @@ class DingRequest(object):
         :param language: language
         :return:
         """
-        assert dept_id is not None, 'dept_id is required'
+        if dept_id is None:
+            raise ValueError('dept_id is required')
         response = await self.post_response(
-            join_url(self.url_prefix, f'topapi/v2/department/get?access_token={await self.latest_token()}'), {
+            self._EP['department_get'], {
                 'dept_id': dept_id,
                 'language': language
-            })
-        check_response_error(response)
-        return response['result']
+            }, params={'access_token': await self.latest_token()})
+        return _unwrap_old(response)
 
     async def department_users(self, dept_id, cursor=0, size=100, language='zh_CN', contain_access_limit=False):
         """
@@ -242,34 +598,102 @@ class DingRequest(object):
         :param contain_access_limit: Whether to return an employee with restricted access
         :return:
         """
-        assert dept_id is not None, 'dept_id is required'
+        if dept_id is None:
+            raise ValueError('dept_id is required')
         response = await self.post_response(
-            join_url(self.url_prefix, f'topapi/v2/user/list?access_token={await self.latest_token()}'), {
+            self._EP['user_list'], {
                 'dept_id': dept_id,
                 'cursor': cursor,
                 'size': size,
                 'language': language,
                 'contain_access_limit': contain_access_limit
-            })
-        check_response_error(response)
-        return response['result']
+            }, params={'access_token': await self.latest_token()})
+        return _unwrap_old(response)
+
+    async def department_users_all(self, dept_id, size=100, concurrency=8, language='zh_CN',
+                                   contain_access_limit=False):
+        """
+        get all users of a department, fetching pages speculatively in concurrent waves.
+        next_cursor advances by size, so page n always sits at cursor n * size and waves
+        of `concurrency` pages can be requested in parallel until one reports no more data
+        :param dept_id: department id
+        :param size: page size
+        :param concurrency: pages fetched in parallel per wave
+        :param language: language
+        :param contain_access_limit: Whether to return an employee with restricted access
+        :return: user list
+        """
+        first = await self.department_users(dept_id, cursor=0, size=size, language=language,
+                                            contain_access_limit=contain_access_limit)
+        users = list(first['list'])
+        if not first.get('has_more'):
+            return users
+
+        semaphore = asyncio.Semaphore(concurrency)
+
+        async def _page(cursor):
+            async with semaphore:
+                return await self.department_users(dept_id, cursor=cursor, size=size, language=language,
+                                                   contain_access_limit=contain_access_limit)
+
+        page = 1
+        has_more = True
+        while has_more:
+            wave = await asyncio.gather(*[_page((page + i) * size) for i in range(concurrency)])
+            for result in wave:
+                users.extend(result['list'])
+                if not result.get('has_more'):
+                    has_more = False
+                    break
+            page += concurrency
+        return users
+
+    async def department_tree_users(self, dept_id, size=100, concurrency=8):
+        """
+        get users of a department and all its sub departments, walking the subtree concurrently
+        :param dept_id: root department id
+        :param size: page size
+        :param concurrency: pages fetched in parallel per department
+        :return: user list
+        """
+        users, sub_ids = await asyncio.gather(
+            self.department_users_all(dept_id, size=size, concurrency=concurrency),
+            self.department_listsubid(dept_id)
+        )
+        if sub_ids:
+            sub_users = await asyncio.gather(
+                *[self.department_tree_users(sub_id, size=size, concurrency=concurrency) for sub_id in sub_ids])
+            for sub in sub_users:
+                users.extend(sub)
+        return users
 
     async def upload_media(self, media_type, media_file, filename):
         """
-        upload media
+        upload media, the body is streamed instead of buffered when a path or file
+        object is passed, so large files never live fully in memory
         :param media_type: image, voice, video or file
-        :param media_file: media file
+        :param media_file: media bytes, a file-like object, or a path to the file
         :param filename: media filename
         :return: media_id
         """
-        data = aiohttp.FormData()
-        data.add_field('type', media_type)
-        data.add_field('media', media_file, filename=filename, content_type='application/octet-stream')
-        response = await self.post_response(
-            join_url(self.url_prefix, f'media/upload?access_token={await self.latest_token()}&type={media_type}'),
-            None, data)
-        check_response_error(response)
-        return response['media_id']
+        opened = None
+        if isinstance(media_file, str):
+            opened = await aiofiles.open(media_file, 'rb') if aiofiles is not None else open(media_file, 'rb')
+            media_file = opened
+        try:
+            data = aiohttp.FormData()
+            data.add_field('type', media_type)
+            data.add_field('media', media_file, filename=filename,
+                           content_type=MEDIA_CONTENT_TYPES.get(media_type, 'application/octet-stream'))
+            response = await self.post_response(
+                self._EP['media_upload'],
+                None, data, params={'access_token': await self.latest_token(), 'type': media_type})
+        finally:
+            if opened is not None:
+                closing = opened.close()
+                if asyncio.iscoroutine(closing):
+                    await closing
+        return _unwrap_old(response, 'media_id')
 
     async def send_message(self, message):
         """
@@ -278,8 +702,8 @@ class DingRequest(object):
         :return:
         """
         response = await self.post_response(
-            join_url(self.url_prefix,
-                     f'topapi/message/corpconversation/asyncsend_v2?access_token={await self.latest_token()}'), message)
+            self._EP['message_asyncsend'], message,
+            params={'access_token': await self.latest_token()})
         check_response_error(response)
         return {
             'request_id': response['request_id'],
@@ -298,37 +722,34 @@ class DingRequest(object):
         :param process_feature_config: process feature config, not required
         :return:
         """
-        assert name is not None, 'name is required'
+        if name is None:
+            raise ValueError('name is required')
         response = await self.post_response(
-            join_url(self.new_api_url_prefix, 'v1.0/workflow/processCentres/schemas'), {
+            self._EP['oa_schemas'], {
                 'processCode': process_code,
                 'name': name,
                 'description': description,
                 'formComponents': form_components,
                 'processFeatureConfig': process_feature_config
             },
-            headers={
-                'x-acs-dingtalk-access-token': await self.latest_token()
-            }
+            new_api=True
         )
-        check_new_response_error(response)
-        return response['result']
+        return _unwrap_new(response)
 
+    @_ttl_cache(600)
     async def get_custom_oa_process_code(self, name):
         """
         get custom oa process code
         :param name: form name
         :return:
         """
-        assert name is not None, 'name is required'
+        if name is None:
+            raise ValueError('name is required')
         response = await self.get_response(
-            join_url(self.new_api_url_prefix, '/v1.0/workflow/processCentres/schemaNames/processCodes'), {
+            self._EP['oa_schema_process_codes'], {
                 'name': name
-            }, headers={
-                'x-acs-dingtalk-access-token': await self.latest_token()
-            })
-        check_new_response_error(response)
-        return response['result']
+            }, new_api=True)
+        return _unwrap_new(response)
 
     async def delete_custom_oa_template(self, process_code, clean_running_task=False):
         """
@@ -337,17 +758,15 @@ class DingRequest(object):
         :param clean_running_task: Whether to delete the running task
         :return:
         """
-        assert process_code is not None, 'process_code is required'
+        if process_code is None:
+            raise ValueError('process_code is required')
         response = await self.delete_response(
-            join_url(self.new_api_url_prefix, f'/v1.0/workflow/processCentres/schemas'), {
+            self._EP['oa_schemas'], {
                 'processCode': process_code,
                 'cleanRunningTask': False if clean_running_task == 'false' else True
             },
-            headers={
-                'x-acs-dingtalk-access-token': await self.latest_token()
-            })
-        check_new_response_error(response)
-        return response['result']
+            new_api=True)
+        return _unwrap_new(response)
 
     async def create_custom_oa_instance(self, process_code, originator_user_id, url, form_component_value_list=None,
                                         title=None, notifiers=None):
@@ -361,10 +780,12 @@ class DingRequest(object):
         :param notifiers: notifiers list
         :return:
         """
-        assert process_code is not None, 'process_code is required'
-        assert originator_user_id is not None, 'originator_user_id is required'
+        if process_code is None:
+            raise ValueError('process_code is required')
+        if originator_user_id is None:
+            raise ValueError('originator_user_id is required')
         response = await self.post_response(
-            join_url(self.new_api_url_prefix, '/v1.0/workflow/processCentres/instances'), {
+            self._EP['oa_instances'], {
                 'processCode': process_code,
                 'originatorUserId': originator_user_id,
                 'formComponentValueList': form_component_value_list,
@@ -372,12 +793,9 @@ class DingRequest(object):
                 'url': url,
                 'notifiers': notifiers
             },
-            headers={
-                'x-acs-dingtalk-access-token': await self.latest_token()
-            }
+            new_api=True
         )
-        check_new_response_error(response)
-        return response['result']
+        return _unwrap_new(response)
 
     async def update_custom_oa_instance_state(self, process_instance_id, to_status, result=None, notifiers=None):
         """
@@ -388,21 +806,20 @@ class DingRequest(object):
         :param notifiers: notifiers list
         :return:
         """
-        assert process_instance_id is not None, 'process_instance_id is required'
-        assert to_status is not None, 'to_status is required'
+        if process_instance_id is None:
+            raise ValueError('process_instance_id is required')
+        if to_status is None:
+            raise ValueError('to_status is required')
         response = await self.put_response(
-            join_url(self.new_api_url_prefix, '/v1.0/workflow/processCentres/instances'), {
+            self._EP['oa_instances'], {
                 'processInstanceId': process_instance_id,
                 'status': to_status,
                 'result': result,
                 'notifiers': notifiers
             },
-            headers={
-                'x-acs-dingtalk-access-token': await self.latest_token()
-            }
+            new_api=True
         )
-        check_new_response_error(response)
-        return response['success']
+        return _unwrap_new(response, 'success')
 
     async def update_custom_oa_instance_state_batch(self, update_process_instance_requests):
         """
@@ -410,18 +827,37 @@ class DingRequest(object):
         :param update_process_instance_requests: is a list of function update_custom_oa_instance_state's params
         :return:
         """
-        assert len(
-            update_process_instance_requests) > 0, "update_process_instance_requests's length must be greater than 0"
+        if not update_process_instance_requests:
+            raise ValueError("update_process_instance_requests's length must be greater than 0")
         response = await self.put_response(
-            join_url(self.new_api_url_prefix, '/v1.0/workflow/processCentres/instances/batch'), {
+            self._EP['oa_instances_batch'], {
                 'updateProcessInstanceRequests': update_process_instance_requests
             },
-            headers={
-                'x-acs-dingtalk-access-token': await self.latest_token()
-            }
+            new_api=True
         )
-        check_new_response_error(response)
-        return response['success']
+        return _unwrap_new(response, 'success')
+
+    async def update_custom_oa_instance_state_many(self, update_process_instance_requests, chunk_size=20,
+                                                   concurrency=4):
+        """
+        update custom oa instance states through the batch endpoint, chunking the
+        requests and issuing the chunks in parallel instead of one call per instance
+        :param update_process_instance_requests: list of update_custom_oa_instance_state params
+        :param chunk_size: instances per batch call
+        :param concurrency: batch calls in flight at once
+        :return: list of per-chunk success flags
+        """
+        if not update_process_instance_requests:
+            raise ValueError("update_process_instance_requests's length must be greater than 0")
+        semaphore = asyncio.Semaphore(concurrency)
+
+        async def _chunk(requests):
+            async with semaphore:
+                return await self.update_custom_oa_instance_state_batch(requests)
+
+        return await asyncio.gather(
+            *[_chunk(update_process_instance_requests[i:i + chunk_size])
+              for i in range(0, len(update_process_instance_requests), chunk_size)])
 
     async def create_custom_oa_task(self, process_instance_id, activity_id=None, tasks=None):
         """
@@ -431,16 +867,15 @@ class DingRequest(object):
         :param tasks: tasks list
         :return:
         """
-        assert process_instance_id is not None, 'process_instance_id is required'
+        if process_instance_id is None:
+            raise ValueError('process_instance_id is required')
         response = await self.post_response(
-            join_url(self.new_api_url_prefix, '/v1.0/workflow/processCentres/tasks'), {
+            self._EP['oa_tasks'], {
                 'processInstanceId': process_instance_id,
                 'activityId': activity_id,
                 'tasks': tasks
             },
-            headers={
-                'x-acs-dingtalk-access-token': await self.latest_token()
-            }
+            new_api=True
         )
         check_new_response_error(response)
         return {
@@ -457,17 +892,16 @@ class DingRequest(object):
         :param create_before: create before
         :return:
         """
-        assert user_id is not None, 'user_id is required'
+        if user_id is None:
+            raise ValueError('user_id is required')
         response = await self.get_response(
-            join_url(self.new_api_url_prefix, '/v1.0/workflow/processCentres/todoTasks'), {
+            self._EP['oa_todo_tasks'], {
                 'userId': user_id,
                 'pageNumber': page_number,
                 'pageSize': page_size,
                 'createBefore': create_before
             },
-            headers={
-                'x-acs-dingtalk-access-token': await self.latest_token()
-            }
+            new_api=True
         )
         check_new_response_error(response)
         return {
@@ -482,18 +916,16 @@ class DingRequest(object):
         :param process_instance_id: process instance id
         :return:
         """
-        assert len(tasks) > 0, "tasks's length must be greater than 0"
+        if not tasks:
+            raise ValueError("tasks's length must be greater than 0")
         response = await self.put_response(
-            join_url(self.new_api_url_prefix, '/v1.0/workflow/processCentres/tasks'), {
+            self._EP['oa_tasks'], {
                 'tasks': tasks,
                 'processInstanceId': process_instance_id
             },
-            headers={
-                'x-acs-dingtalk-access-token': await self.latest_token()
-            }
+            new_api=True
         )
-        check_new_response_error(response)
-        return response['success']
+        return _unwrap_new(response, 'success')
 
     async def cancel_custom_oa_tasks_batch(self, process_instance_id, activity_id, activity_ids=None):
         """
@@ -503,20 +935,19 @@ class DingRequest(object):
         :param activity_ids: ID of the backlog group list
         :return:
         """
-        assert process_instance_id is not None, 'process_instance_id is required'
-        assert activity_id is not None, 'activity_id is required'
+        if process_instance_id is None:
+            raise ValueError('process_instance_id is required')
+        if activity_id is None:
+            raise ValueError('activity_id is required')
         response = await self.delete_response(
-            join_url(self.new_api_url_prefix, '/v1.0/workflow/processCentres/tasks/cancel'), {
+            self._EP['oa_tasks_cancel'], {
                 'processInstanceId': process_instance_id,
                 'activityId': activity_id,
                 'activityIds': activity_ids,
             },
-            headers={
-                'x-acs-dingtalk-access-token': await self.latest_token()
-            }
+            new_api=True
         )
-        check_new_response_error(response)
-        return response['success']
+        return _unwrap_new(response, 'success')
 
     # endregion
 
@@ -532,21 +963,19 @@ class DingRequest(object):
         :param template_config: template global config
         :return:
         """
-        assert name is not None, 'name is required'
+        if name is None:
+            raise ValueError('name is required')
         response = await self.post_response(
-            join_url(self.new_api_url_prefix, '/v1.0/workflow/forms'), {
+            self._EP['official_forms'], {
                 'processCode': process_code,
                 'name': name,
                 'description': description,
                 'formComponents': form_components,
                 'templateConfig': template_config
             },
-            headers={
-                'x-acs-dingtalk-access-token': await self.latest_token()
-            }
+            new_api=True
         )
-        check_new_response_error(response)
-        return response['result']
+        return _unwrap_new(response)
 
     async def get_official_oa_form_schemas(self, process_code, app_uuid=None):
         """
@@ -555,18 +984,16 @@ class DingRequest(object):
         :param app_uuid: Application builds quarantine information
         :return:
         """
-        assert process_code is not None, 'process_code is required'
+        if process_code is None:
+            raise ValueError('process_code is required')
         response = await self.get_response(
-            join_url(self.new_api_url_prefix, '/v1.0/workflow/forms/schemas/processCodes'), {
+            self._EP['official_form_schemas'], {
                 'processCode': process_code,
                 'appUuid': app_uuid
             },
-            headers={
-                'x-acs-dingtalk-access-token': await self.latest_token()
-            }
+            new_api=True
         )
-        check_new_response_error(response)
-        return response['result']
+        return _unwrap_new(response)
 
     async def get_official_oa_processes_nodes(self, process_code, dept_id, user_id, form_component_values):
         """
@@ -577,22 +1004,22 @@ class DingRequest(object):
         :param form_component_values: form component values
         :return:
         """
-        assert process_code is not None, 'process_code is required'
-        assert dept_id is not None, 'dept_id is required'
-        assert user_id is not None, 'user_id is required'
+        if process_code is None:
+            raise ValueError('process_code is required')
+        if dept_id is None:
+            raise ValueError('dept_id is required')
+        if user_id is None:
+            raise ValueError('user_id is required')
         response = await self.post_response(
-            join_url(self.new_api_url_prefix, '/v1.0/workflow/processes/forecast'), {
+            self._EP['official_forecast'], {
                 'processCode': process_code,
                 'deptId': dept_id,
                 'userId': user_id,
                 'formComponentValues': form_component_values
             },
-            headers={
-                'x-acs-dingtalk-access-token': await self.latest_token()
-            }
+            new_api=True
         )
-        check_new_response_error(response)
-        return response['result']
+        return _unwrap_new(response)
 
     async def create_official_oa_instance(self, originator_user_id, process_code, form_component_values, dept_id=None,
                                           microapp_agent_id=None, approvers=None, cc_list=None, cc_position=None,
@@ -610,11 +1037,14 @@ class DingRequest(object):
         :param target_select_actioners: When using the approval flow template, the mandatory list of optional operators on the node rule in the process prediction result
         :return:
         """
-        assert originator_user_id is not None, 'originator_user_id is required'
-        assert process_code is not None, 'process_code is required'
-        assert form_component_values is not None, 'form_component_values is required'
+        if originator_user_id is None:
+            raise ValueError('originator_user_id is required')
+        if process_code is None:
+            raise ValueError('process_code is required')
+        if form_component_values is None:
+            raise ValueError('form_component_values is required')
         response = await self.post_response(
-            join_url(self.new_api_url_prefix, '/v1.0/workflow/processInstances'), {
+            self._EP['official_instances'], {
                 'originatorUserId': originator_user_id,
                 'deptId': dept_id,
                 'processCode': process_code,
@@ -625,12 +1055,9 @@ class DingRequest(object):
                 'ccPosition': cc_position,
                 'targetSelectActioners': target_select_actioners
             },
-            headers={
-                'x-acs-dingtalk-access-token': await self.latest_token()
-            }
+            new_api=True
         )
-        check_new_response_error(response)
-        return response['instanceId']
+        return _unwrap_new(response, 'instanceId')
 
     async def get_official_oa_instance_id_list(self, process_code, start_time, end_time=None, next_token=None,
                                                max_results=20, user_ids=None, statuses=None):
@@ -645,10 +1072,12 @@ class DingRequest(object):
         :param statuses: NEW/RUNNING/COMPLETED/TERMINATED/CANCELED
         :return:
         """
-        assert process_code is not None, 'process_code is required'
-        assert start_time is not None, 'start_time is required'
+        if process_code is None:
+            raise ValueError('process_code is required')
+        if start_time is None:
+            raise ValueError('start_time is required')
         response = await self.post_response(
-            join_url(self.new_api_url_prefix, '/v1.0/workflow/processes/instanceIds/query'), {
+            self._EP['official_instance_ids_query'], {
                 'processCode': process_code,
                 'startTime': start_time,
                 'endTime': end_time,
@@ -657,12 +1086,29 @@ class DingRequest(object):
                 'userIds': user_ids,
                 'statuses': statuses
             },
-            headers={
-                'x-acs-dingtalk-access-token': await self.latest_token()
-            }
+            new_api=True
         )
-        check_new_response_error(response)
-        return response['result']
+        return _unwrap_new(response)
+
+    async def get_official_oa_instance_id_list_all(self, process_code, start_time, end_time=None,
+                                                   max_results=20, user_ids=None, statuses=None):
+        """
+        drain every page of get_official_oa_instance_id_list. the cursor is an
+        opaque nextToken revealed one page at a time, so pages cannot be fetched
+        in parallel like department_users_all; this helper at least keeps the
+        drain loop on the shared connection instead of in every caller
+        :return: instance id list
+        """
+        instance_ids = []
+        next_token = None
+        while True:
+            result = await self.get_official_oa_instance_id_list(
+                process_code, start_time, end_time=end_time, next_token=next_token,
+                max_results=max_results, user_ids=user_ids, statuses=statuses)
+            instance_ids.extend(result.get('list') or [])
+            next_token = result.get('nextToken')
+            if not next_token:
+                return instance_ids
 
     async def get_official_oa_instance_detail(self, process_instance_id):
         """
@@ -670,17 +1116,15 @@ class DingRequest(object):
         :param process_instance_id: process instance id
         :return:
         """
-        assert process_instance_id is not None, 'process_instance_id is required'
+        if process_instance_id is None:
+            raise ValueError('process_instance_id is required')
         response = await self.get_response(
-            join_url(self.new_api_url_prefix, '/v1.0/workflow/processInstances'), {
+            self._EP['official_instances'], {
                 'processInstanceId': process_instance_id
             },
-            headers={
-                'x-acs-dingtalk-access-token': await self.latest_token()
-            }
+            new_api=True
         )
-        check_new_response_error(response)
-        return response['result']
+        return _unwrap_new(response)
 
     async def redirect_official_oa_task(self, task_id, to_user_id, operate_user_id, remark=None, action_name=None):
         """
@@ -692,23 +1136,23 @@ class DingRequest(object):
         :param action_name: action node name
         :return:
         """
-        assert task_id is not None, 'task_id is required'
-        assert to_user_id is not None, 'to_user_id is required'
-        assert operate_user_id is not None, 'operate_user_id is required'
+        if task_id is None:
+            raise ValueError('task_id is required')
+        if to_user_id is None:
+            raise ValueError('to_user_id is required')
+        if operate_user_id is None:
+            raise ValueError('operate_user_id is required')
         response = await self.post_response(
-            join_url(self.new_api_url_prefix, '/v1.0/workflow/tasks/redirect'), {
+            self._EP['official_tasks_redirect'], {
                 'taskId': task_id,
                 'toUserId': to_user_id,
                 'operateUserId': operate_user_id,
                 'remark': remark,
                 'actionName': action_name
             },
-            headers={
-                'x-acs-dingtalk-access-token': await self.latest_token()
-            }
+            new_api=True
         )
-        check_new_response_error(response)
-        return response['result']
+        return _unwrap_new(response)
 
     async def get_official_oa_spaces_infos(self, user_id, agent_id=None):
         """
@@ -717,18 +1161,16 @@ class DingRequest(object):
         :param agent_id: app agent id
         :return:
         """
-        assert user_id is not None, 'user_id is required'
+        if user_id is None:
+            raise ValueError('user_id is required')
         response = await self.post_response(
-            join_url(self.new_api_url_prefix, '/v1.0/workflow/processInstances/spaces/infos/query'), {
+            self._EP['official_spaces_infos'], {
                 'userId': user_id,
                 'agentId': agent_id
             },
-            headers={
-                'x-acs-dingtalk-access-token': await self.latest_token()
-            }
+            new_api=True
         )
-        check_new_response_error(response)
-        return response['result']
+        return _unwrap_new(response)
 
     async def create_official_oa_approve_comment(self, process_instance_id, text, comment_user_id, file=None):
         """
@@ -739,22 +1181,22 @@ class DingRequest(object):
         :param file: comment dingtalk file info, reference to https://open.dingtalk.com/document/orgapp-server/add-an-approval-comment-pop
         :return:
         """
-        assert process_instance_id is not None, 'process_instance_id is required'
-        assert text is not None, 'text is required'
-        assert comment_user_id is not None, 'comment_user_id is required'
+        if process_instance_id is None:
+            raise ValueError('process_instance_id is required')
+        if text is None:
+            raise ValueError('text is required')
+        if comment_user_id is None:
+            raise ValueError('comment_user_id is required')
         response = await self.post_response(
-            join_url(self.new_api_url_prefix, '/v1.0/workflow/processInstances/comments'), {
+            self._EP['official_comments'], {
                 'processInstanceId': process_instance_id,
                 'text': text,
                 'commentUserId': comment_user_id,
                 'file': file
             },
-            headers={
-                'x-acs-dingtalk-access-token': await self.latest_token()
-            }
+            new_api=True
         )
-        check_new_response_error(response)
-        return response['result']
+        return _unwrap_new(response)
 
     async def execute_official_oa_task(self, process_instance_id, task_id, result, actioner_user_id, remark=None,
                                        file=None):
@@ -768,12 +1210,16 @@ class DingRequest(object):
         :param file: dingtalk file info
         :return:
         """
-        assert process_instance_id is not None, 'process_instance_id is required'
-        assert task_id is not None, 'task_id is required'
-        assert result == 'agree' or result == 'refuse', 'result must be agree or refuse'
-        assert actioner_user_id is not None, 'actioner_user_id is required'
+        if process_instance_id is None:
+            raise ValueError('process_instance_id is required')
+        if task_id is None:
+            raise ValueError('task_id is required')
+        if result not in _OA_TASK_RESULTS:
+            raise ValueError('result must be agree or refuse')
+        if actioner_user_id is None:
+            raise ValueError('actioner_user_id is required')
         response = await self.post_response(
-            join_url(self.new_api_url_prefix, '/v1.0/workflow/processInstances/execute'), {
+            self._EP['official_execute'], {
                 'processInstanceId': process_instance_id,
                 'taskId': task_id,
                 'result': result,
@@ -781,12 +1227,9 @@ class DingRequest(object):
                 'remark': remark,
                 'file': file
             },
-            headers={
-                'x-acs-dingtalk-access-token': await self.latest_token()
-            }
+            new_api=True
         )
-        check_new_response_error(response)
-        return response['result']
+        return _unwrap_new(response)
 
     async def terminate_official_oa_instance(self, process_instance_id, operating_user_id=None, is_system=None,
                                              remark=None):
@@ -798,20 +1241,18 @@ class DingRequest(object):
         :param is_system: is system terminate
         :return:
         """
-        assert process_instance_id is not None, 'process_instance_id is required'
+        if process_instance_id is None:
+            raise ValueError('process_instance_id is required')
         response = await self.post_response(
-            join_url(self.new_api_url_prefix, '/v1.0/workflow/processInstances/terminate'), {
+            self._EP['official_terminate'], {
                 'processInstanceId': process_instance_id,
                 'operatingUserId': operating_user_id,
                 'remark': remark,
                 'isSystem': is_system
             },
-            headers={
-                'x-acs-dingtalk-access-token': await self.latest_token()
-            }
+            new_api=True
         )
-        check_new_response_error(response)
-        return response['result']
+        return _unwrap_new(response)
 
     async def get_official_oa_todo_tasks_number(self, user_id):
         """
@@ -819,17 +1260,15 @@ class DingRequest(object):
         :param user_id: who's to do tasks number in select
         :return:
         """
-        assert user_id is not None, 'user_id is required'
+        if user_id is None:
+            raise ValueError('user_id is required')
         response = await self.get_response(
-            join_url(self.new_api_url_prefix, '/v1.0/workflow/processes/todoTasks/numbers'), {
+            self._EP['official_todo_numbers'], {
                 'userId': user_id
             },
-            headers={
-                'x-acs-dingtalk-access-token': await self.latest_token()
-            }
+            new_api=True
         )
-        check_new_response_error(response)
-        return response['result']
+        return _unwrap_new(response)
 
     async def get_user_official_oa_tasks(self, user_id, max_results=100, next_token=None):
         """
@@ -839,44 +1278,48 @@ class DingRequest(object):
         :param next_token: page cursor, first page is None
         :return:
         """
-        assert user_id is not None, 'user_id is required'
+        if user_id is None:
+            raise ValueError('user_id is required')
         response = await self.get_response(
-            join_url(self.new_api_url_prefix, '/v1.0/workflow/processes/userVisibilities/templates'), {
+            self._EP['official_visible_templates'], {
                 'userId': user_id,
                 'maxResults': max_results,
                 'nextToken': next_token
             },
-            headers={
-                'x-acs-dingtalk-access-token': await self.latest_token()
-            }
+            new_api=True
         )
-        check_new_response_error(response)
-        return response['result']
+        return _unwrap_new(response)
 
     async def get_user_official_oa_templates(self, user_id):
         """
         get the form templates which user has a manageable approval form in the current enterprise
         :return:
         """
-        assert user_id is not None, 'user_id is required'
+        if user_id is None:
+            raise ValueError('user_id is required')
         response = await self.get_response(
-            join_url(self.new_api_url_prefix, '/v1.0/workflow/processes/managements/templates'), {
+            self._EP['official_management_templates'], {
                 'userId': user_id
             },
-            headers={
-                'x-acs-dingtalk-access-token': await self.latest_token()
-            }
+            new_api=True
         )
-        check_new_response_error(response)
-        return response['result']
+        return _unwrap_new(response)
 # endregion
 
 
+_instance_cache = {}
+
+
 def ding_request_instance(app_key, app_secret):
     """
-    if you want to use custom DingRequest class or Store class, you can set monkey patch to this function
+    if you want to use custom DingRequest class or Store class, you can set monkey patch to this function.
+    instances are kept per (app_key, app_secret) for the process lifetime so every
+    caller shares one connection pool and token cache
     :param app_key:
     :param app_secret:
     :return:
     """
-    return DingRequest(app_key, app_secret)
+    instance = _instance_cache.get((app_key, app_secret))
+    if instance is None:
+        instance = _instance_cache.setdefault((app_key, app_secret), DingRequest(app_key, app_secret))
+    return instance
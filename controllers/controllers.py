@@ -1,6 +1,5 @@
 # -*- coding: utf-8 -*-
 import json
-import asyncio
 import re
 import warnings
 from urllib import parse
@@ -10,6 +9,7 @@ from odoo.http import request, route
 
 from ..common.ding_request import join_url, ding_request_instance
 from ..common.DingCallbackCrypto import DingCallbackCrypto3
+from ..common.utils import run_async
 
 # Crypto will show warning, ignore it
 warnings.filterwarnings("ignore", category=DeprecationWarning)
@@ -59,13 +59,7 @@ class DingTalkController(http.Controller):
                 'accessToken']
             return await ding_request.get_user_info_by_access_token(access_token)
 
-        loop = asyncio.new_event_loop()
-        asyncio.set_event_loop(loop)
-        get_user_info = loop.create_task(_get_user_info())
-        loop.run_until_complete(get_user_info)
-        loop.close()
-
-        user_info = get_user_info.result()
+        user_info = run_async(_get_user_info())
         employee = request.env['hr.employee'].sudo().search([('ding_id', '=', user_info['unionId'])])
         if employee.user_id.id:
             self.force_authenticate(request.session, employee.user_id)
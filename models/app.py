@@ -1,14 +1,15 @@
 import asyncio
-import threading
+import logging
 import time
-import traceback
 
 from odoo import models, fields, api
 from odoo.exceptions import UserError
 from odoo.tools.translate import _
 
-from ..common.ding_request import ding_request_instance
-from ..common.utils import to_sync, get_now_time_str, list_to_str
+from ..common.ding_request import DingRequest, ding_request_instance
+from ..common.utils import to_sync, get_event_loop, get_now_time_str, list_to_str, run_async
+
+_logger = logging.getLogger(__name__)
 
 
 class App(models.Model):
@@ -27,6 +28,16 @@ class App(models.Model):
     token = fields.Char(string='Token')
     encoding_aes_key = fields.Char(string='EncodingAESKey')
 
+    @property
+    def ding_request(self):
+        """
+        dingtalk client for this app's credentials. instances are cached per
+        (app_key, app_secret) at module level, so repeated access is cheap and
+        every caller shares one connection pool
+        :return:
+        """
+        return ding_request_instance(self.app_key, self.app_secret)
+
     def run_ding_sync(self):
         self.env['bus.bus']._sendone(self.env.user.partner_id, 'simple_notification', {
             'title': 'Sync Start......',
@@ -34,17 +45,12 @@ class App(models.Model):
             'warning': True
         })
 
-        # create a threading to avoid odoo ui blocking
-        def _sync():
-            loop = asyncio.new_event_loop()
-            asyncio.set_event_loop(loop)
-            asyncio.run(self.sync_ding_organization())
-
-        thread = threading.Thread(target=_sync)
-        thread.start()
+        # schedule on the shared background loop to avoid odoo ui blocking;
+        # the coroutine posts its own 'Sync End' notification when it finishes
+        asyncio.run_coroutine_threadsafe(self.sync_ding_organization(), get_event_loop())
 
     async def sync_ding_organization(self):
-        start = time.time()
+        start = time.monotonic()
         uid = self.env.uid
         is_success = True
         with self.env.registry.cursor() as new_cr:
@@ -52,21 +58,23 @@ class App(models.Model):
 
             detail_log = f'start sync at {get_now_time_str()}......'
             try:
-                ding_request = ding_request_instance(self.app_key, self.app_secret)
+                ding_request = self.ding_request
 
                 # get dingtalk auth scope
                 auth_scopes = await ding_request.get_auth_scopes()
 
-                await self.env['hr.department'].with_context(
-                    self.env.context, ding_app=self, ding_request=ding_request,
-                    auth_scopes=auth_scopes
-                ).sync_ding_department()
+                ctx = {**self.env.context, 'ding_app': self, 'ding_request': ding_request,
+                       'auth_scopes': auth_scopes}
+                await self.env['hr.department'].with_context(**ctx).sync_ding_department()
                 detail_log += f'\nsync success!'
-            except Exception:
+            except Exception as exc:
                 is_success = False
-                detail_log += f'\nsync failed, error: \n{traceback.format_exc()}'
+                # full traceback goes to the odoo log; the dingtalk.log row only
+                # needs the cheap repr
+                _logger.exception('dingtalk organization sync failed')
+                detail_log += f'\nsync failed, error: \n{exc!r}'
             finally:
-                detail_log += f'\nsync end at {get_now_time_str()}, cost {round(time.time() - start, 2)}s'
+                detail_log += f'\nsync end at {get_now_time_str()}, cost {round(time.monotonic() - start, 2)}s'
                 company_id = self.company_id.id
                 self.env['dingtalk.log'].create({
                     'company_id': company_id,
@@ -79,6 +87,23 @@ class App(models.Model):
                     'warning': True if is_success else False
                 })
 
+    def __getattr__(self, name):
+        """
+        forward any public DingRequest coroutine method without a dedicated wrapper
+        through the shared event loop, so new endpoints are callable on the app
+        record directly. the explicit @api.model wrappers above stay for RPC
+        exposure and documentation
+        :param name: attribute name
+        :return:
+        """
+        if not name.startswith('_') and asyncio.iscoroutinefunction(getattr(DingRequest, name, None)):
+            def _forward(*args, **kwargs):
+                ding_request = self.ding_request
+                return run_async(getattr(ding_request, name)(*args, **kwargs))
+
+            return _forward
+        raise AttributeError(f"'{type(self).__name__}' object has no attribute '{name}'")
+
     def on_ding_bpms_task_change(self, content, app):
         """
         when dingtalk bpms task change the method will be callback, can override this method in model
@@ -107,7 +132,7 @@ class App(models.Model):
         :param filename: media filename
         :return: media_id
         """
-        ding_request = ding_request_instance(self.app_key, self.app_secret)
+        ding_request = self.ding_request
         return await ding_request.upload_media(media_type, media_file, filename)
 
     @api.model
@@ -124,16 +149,14 @@ class App(models.Model):
         if len(to_users) == 0 and len(to_departments) == 0:
             raise UserError(_('Please select the user or department to send the message!'))
 
-        ding_request = ding_request_instance(self.app_key, self.app_secret)
-
-        userid_list = None if to_users == 'to_all_user' else list_to_str(to_users)
-        to_all_user = None if to_users != 'to_all_user' else True
+        ding_request = self.ding_request
+        to_all_user = to_users == 'to_all_user'
 
         return await ding_request.send_message(dict(
             agentid=self.agentid,
             agent_id=self.agentid,
-            userid_list=userid_list,
-            to_all_user=to_all_user,
+            userid_list=None if to_all_user else list_to_str(to_users),
+            to_all_user=to_all_user or None,
             dept_id_list=list_to_str(to_departments),
             msg=msg
         ))
@@ -151,7 +174,7 @@ class App(models.Model):
         :param process_feature_config: process feature config, not required
         :return:
         """
-        ding_request = ding_request_instance(self.app_key, self.app_secret)
+        ding_request = self.ding_request
         return await ding_request.create_or_update_custom_oa_template(process_code, name, form_components, description,
                                                                       process_feature_config)
 
@@ -163,7 +186,7 @@ class App(models.Model):
         :param name: form name
         :return:
         """
-        ding_request = ding_request_instance(self.app_key, self.app_secret)
+        ding_request = self.ding_request
         return await ding_request.get_custom_oa_process_code(name)
 
     @api.model
@@ -175,7 +198,7 @@ class App(models.Model):
         :param clean_running_task: Whether to delete the running task
         :return:
         """
-        ding_request = ding_request_instance(self.app_key, self.app_secret)
+        ding_request = self.ding_request
         return await ding_request.delete_custom_oa_template(process_code, clean_running_task)
 
     @api.model
@@ -192,7 +215,7 @@ class App(models.Model):
         :param notifiers: notifiers list
         :return:
         """
-        ding_request = ding_request_instance(self.app_key, self.app_secret)
+        ding_request = self.ding_request
         return await ding_request.create_custom_oa_instance(process_code, originator_user_id, url,
                                                             form_component_value_list, title, notifiers)
 
@@ -207,7 +230,7 @@ class App(models.Model):
         :param notifiers: notifiers list
         :return:
         """
-        ding_request = ding_request_instance(self.app_key, self.app_secret)
+        ding_request = self.ding_request
         return await ding_request.update_custom_oa_instance_state(process_instance_id, to_status, result, notifiers)
 
     @api.model
@@ -219,7 +242,7 @@ class App(models.Model):
         reference https://open.dingtalk.com/document/orgapp-server/update-the-status-of-multiple-instances-at-a-time-new
         :return:
         """
-        ding_request = ding_request_instance(self.app_key, self.app_secret)
+        ding_request = self.ding_request
         return await ding_request.update_custom_oa_instance_state_batch(update_process_instance_requests)
 
     @api.model
@@ -232,7 +255,7 @@ class App(models.Model):
         :param tasks: tasks list
         :return:
         """
-        ding_request = ding_request_instance(self.app_key, self.app_secret)
+        ding_request = self.ding_request
         return await ding_request.create_custom_oa_task(process_instance_id, activity_id, tasks)
 
     @api.model
@@ -246,9 +269,31 @@ class App(models.Model):
         :param create_before: start timestamp when select, the current time cannot exceed one year
         :return:
         """
-        ding_request = ding_request_instance(self.app_key, self.app_secret)
+        ding_request = self.ding_request
         return await ding_request.get_custom_oa_tasks(user_id, page_number, page_size, create_before)
 
+    @api.model
+    @to_sync
+    async def get_custom_oa_tasks_batch(self, user_ids, page_number=1, page_size=40, create_before=None,
+                                        concurrency=16):
+        """
+        get custom oa process tasks for many users concurrently in one event-loop hop
+        :param user_ids: user dingtalk id list
+        :param page_number: page number
+        :param page_size: page size
+        :param create_before: start timestamp when select, the current time cannot exceed one year
+        :param concurrency: max requests in flight, keep under dingtalk's rate limit
+        :return: task pages, in the same order as user_ids
+        """
+        ding_request = self.ding_request
+        semaphore = asyncio.Semaphore(concurrency)
+
+        async def _tasks(user_id):
+            async with semaphore:
+                return await ding_request.get_custom_oa_tasks(user_id, page_number, page_size, create_before)
+
+        return await asyncio.gather(*(_tasks(u) for u in user_ids))
+
     @api.model
     @to_sync
     async def update_custom_oa_task_state(self, tasks, process_instance_id=None):
@@ -258,7 +303,7 @@ class App(models.Model):
         :param process_instance_id: process instance id
         :return:
         """
-        ding_request = ding_request_instance(self.app_key, self.app_secret)
+        ding_request = self.ding_request
         return await ding_request.update_custom_oa_task_state(tasks, process_instance_id)
 
     @api.model
@@ -271,7 +316,7 @@ class App(models.Model):
         :param activity_ids: ID of the backlog group list
         :return:
         """
-        ding_request = ding_request_instance(self.app_key, self.app_secret)
+        ding_request = self.ding_request
         return await ding_request.cancel_custom_oa_tasks_batch(process_instance_id, activity_id, activity_ids)
 
     @api.model
@@ -287,7 +332,7 @@ class App(models.Model):
         :param template_config: template global config
         :return:
         """
-        ding_request = ding_request_instance(self.app_key, self.app_secret)
+        ding_request = self.ding_request
         return await ding_request.create_or_update_official_oa_template(
             process_code, name, form_components, description, template_config
         )
@@ -301,7 +346,7 @@ class App(models.Model):
         :param app_uuid: Application builds quarantine information
         :return: form schemas
         """
-        ding_request = ding_request_instance(self.app_key, self.app_secret)
+        ding_request = self.ding_request
         return await ding_request.get_official_oa_form_schemas(process_code, app_uuid)
 
     @api.model
@@ -317,7 +362,7 @@ class App(models.Model):
         :param template_config: template global config
         :return:
         """
-        ding_request = ding_request_instance(self.app_key, self.app_secret)
+        ding_request = self.ding_request
         return await ding_request.create_or_update_official_oa_template(
             process_code, name, form_components, description, template_config
         )
@@ -331,7 +376,7 @@ class App(models.Model):
         :param app_uuid: Application builds quarantine information
         :return:
         """
-        ding_request = ding_request_instance(self.app_key, self.app_secret)
+        ding_request = self.ding_request
         return await ding_request.get_official_oa_form_schemas(process_code, app_uuid)
 
     @api.model
@@ -345,7 +390,7 @@ class App(models.Model):
         :param form_component_values: form component values
         :return:
         """
-        ding_request = ding_request_instance(self.app_key, self.app_secret)
+        ding_request = self.ding_request
         return await ding_request.get_official_oa_processes_nodes(process_code, dept_id, user_id, form_component_values)
 
     @api.model
@@ -366,7 +411,7 @@ class App(models.Model):
         :param target_select_actioners: When using the approval flow template, the mandatory list of optional operators on the node rule in the process prediction result
         :return:
         """
-        ding_request = ding_request_instance(self.app_key, self.app_secret)
+        ding_request = self.ding_request
         return await ding_request.create_official_oa_instance(
             originator_user_id, process_code, form_component_values, dept_id, microapp_agent_id, approvers, cc_list,
             cc_position, target_select_actioners
@@ -387,7 +432,7 @@ class App(models.Model):
         :param statuses: NEW/RUNNING/COMPLETED/TERMINATED/CANCELED
         :return:
         """
-        ding_request = ding_request_instance(self.app_key, self.app_secret)
+        ding_request = self.ding_request
         return await ding_request.get_official_oa_instance_id_list(
             process_code, start_time, end_time, next_token, max_results, user_ids, statuses
         )
@@ -400,9 +445,27 @@ class App(models.Model):
         :param process_instance_id: process instance id
         :return:
         """
-        ding_request = ding_request_instance(self.app_key, self.app_secret)
+        ding_request = self.ding_request
         return await ding_request.get_official_oa_instance_detail(process_instance_id)
 
+    @api.model
+    @to_sync
+    async def get_official_oa_instance_details(self, process_instance_ids, concurrency=16):
+        """
+        get many official oa instances concurrently in one event-loop hop
+        :param process_instance_ids: process instance id list
+        :param concurrency: max requests in flight, keep under dingtalk's rate limit
+        :return: instance details, in the same order as process_instance_ids
+        """
+        ding_request = self.ding_request
+        semaphore = asyncio.Semaphore(concurrency)
+
+        async def _detail(process_instance_id):
+            async with semaphore:
+                return await ding_request.get_official_oa_instance_detail(process_instance_id)
+
+        return await asyncio.gather(*(_detail(i) for i in process_instance_ids))
+
     @api.model
     @to_sync
     async def redirect_official_oa_task(self, task_id, to_user_id, operate_user_id, remark=None, action_name=None):
@@ -415,7 +478,7 @@ class App(models.Model):
         :param action_name: action node name
         :return:
         """
-        ding_request = ding_request_instance(self.app_key, self.app_secret)
+        ding_request = self.ding_request
         return await ding_request.redirect_official_oa_task(
             task_id, to_user_id, operate_user_id, remark, action_name
         )
@@ -429,7 +492,7 @@ class App(models.Model):
         :param agent_id: app agent id
         :return:
         """
-        ding_request = ding_request_instance(self.app_key, self.app_secret)
+        ding_request = self.ding_request
         return await ding_request.get_official_oa_spaces_infos(user_id, agent_id)
 
     @api.model
@@ -443,7 +506,7 @@ class App(models.Model):
         :param file: comment dingtalk file info, reference to https://open.dingtalk.com/document/orgapp-server/add-an-approval-comment-pop
         :return:
         """
-        ding_request = ding_request_instance(self.app_key, self.app_secret)
+        ding_request = self.ding_request
         return await ding_request.create_official_oa_approve_comment(
             process_instance_id, text, comment_user_id, file
         )
@@ -462,11 +525,29 @@ class App(models.Model):
         :param file: dingtalk file info
         :return:
         """
-        ding_request = ding_request_instance(self.app_key, self.app_secret)
+        ding_request = self.ding_request
         return await ding_request.execute_official_oa_task(
             process_instance_id, task_id, result, actioner_user_id, remark, file
         )
 
+    @api.model
+    @to_sync
+    async def execute_official_oa_tasks(self, task_requests, concurrency=16):
+        """
+        execute many official oa tasks concurrently in one event-loop hop
+        :param task_requests: list of keyword dicts for execute_official_oa_task
+        :param concurrency: max requests in flight, keep under dingtalk's rate limit
+        :return: results, in the same order as task_requests
+        """
+        ding_request = self.ding_request
+        semaphore = asyncio.Semaphore(concurrency)
+
+        async def _execute(task_request):
+            async with semaphore:
+                return await ding_request.execute_official_oa_task(**task_request)
+
+        return await asyncio.gather(*(_execute(r) for r in task_requests))
+
     @api.model
     @to_sync
     async def terminate_official_oa_instance(self, process_instance_id, operating_user_id=None, is_system=None,
@@ -479,7 +560,7 @@ class App(models.Model):
         :param is_system: is system terminate
         :return:
         """
-        ding_request = ding_request_instance(self.app_key, self.app_secret)
+        ding_request = self.ding_request
         return await ding_request.terminate_official_oa_instance(
             process_instance_id, operating_user_id, is_system, remark
         )
@@ -492,7 +573,7 @@ class App(models.Model):
         :param user_id: who's to do tasks number in select
         :return:
         """
-        ding_request = ding_request_instance(self.app_key, self.app_secret)
+        ding_request = self.ding_request
         return await ding_request.get_official_oa_todo_tasks_number(user_id)
 
     @api.model
@@ -505,7 +586,7 @@ class App(models.Model):
         :param next_token: page cursor, first page is None
         :return:
         """
-        ding_request = ding_request_instance(self.app_key, self.app_secret)
+        ding_request = self.ding_request
         return await ding_request.get_user_official_oa_tasks(user_id, max_results, next_token)
 
     @api.model
@@ -515,5 +596,5 @@ class App(models.Model):
         get the form templates which user has a manageable approval form in the current enterprise
         :return:
         """
-        ding_request = ding_request_instance(self.app_key, self.app_secret)
+        ding_request = self.ding_request
         return await ding_request.get_user_official_oa_templates(user_id)
@@ -1,7 +1,8 @@
 import asyncio
 
-from odoo import models, fields, SUPERUSER_ID, api
+from odoo import models, fields
 from ..common.ding_request import ding_request_instance
+from ..common.utils import gather_all, limit_api, run_async
 
 
 class Department(models.Model):
@@ -15,23 +16,41 @@ class Department(models.Model):
     ding_employee_ids = fields.Many2many('hr.employee', 'ding_employee_department_rel', 'department_id', 'employee_id',
                                          string='Dingtalk Employees')
 
-    async def get_ding_server_depart_tree(self, dep_ids, for_in_callback=None):
+    async def get_ding_server_depart_tree(self, dep_ids, for_in_callback=None, _subid_cache=None):
         """
         get Dingtalk server department id tree
         :param dep_ids: server department id list
         :param for_in_callback: callback function in for loop
+        :param _subid_cache: internal, shared down the recursion to dedupe
+        listsubid calls when auth scopes contain overlapping subtrees
         :return:
         """
         ding_request = self.env.context.get('ding_request')
         tree = []
 
+        if _subid_cache is None:
+            _subid_cache = {}
+
+        def _listsubid(parent_dep_id):
+            # cache the task rather than the result so concurrent walks of the
+            # same department share one in-flight request
+            task = _subid_cache.get(parent_dep_id)
+            if task is None:
+                task = _subid_cache[parent_dep_id] = asyncio.create_task(
+                    limit_api(ding_request.department_listsubid(parent_dep_id)))
+            return task
+
         _tasks = []
 
         async def _append_to_tree(parent_dep_id, _tree):
-            sublist = await ding_request.department_listsubid(parent_dep_id)
+            # start the detail fetch right away so it runs while the subtree is
+            # still being discovered; _sync_dep awaits the in-flight task later
+            detail_task = asyncio.create_task(limit_api(ding_request.department_detail(parent_dep_id)))
+            sublist = await _listsubid(parent_dep_id)
             _tree.append({
                 'id': parent_dep_id,
-                'children': await self.get_ding_server_depart_tree(sublist, for_in_callback)
+                'detail_task': detail_task,
+                'children': await self.get_ding_server_depart_tree(sublist, for_in_callback, _subid_cache)
             })
 
         for dep_id in dep_ids:
@@ -39,7 +58,7 @@ class Department(models.Model):
                 for_in_callback(dep_id)
             _tasks.append(_append_to_tree(dep_id, tree))
 
-        await asyncio.gather(*_tasks)
+        await gather_all(*_tasks)
 
         return tree
 
@@ -58,15 +77,12 @@ class Department(models.Model):
             lambda dep_id: dep_ding_id_list.append(dep_id)
         )
 
-        tasks = []
-
-        # change where the employee in the department status to active = False
-        self.env['hr.employee'].search([('ding_department_ids.ding_id', 'in', dep_ding_id_list)]).write(
-            {'active': False})
+        # collect every unionid seen during the sync instead of deactivating all
+        # employees up front only to reactivate most of them moments later
+        seen_unionids = set()
 
         async def _sync_dep(_dep_leaf, parent_id):
-            _tasks = []
-            dep_detail = await ding_request.department_detail(_dep_leaf['id'])
+            dep_detail = await _dep_leaf['detail_task']
 
             dep = self.search([('ding_id', '=', dep_detail['dept_id'])])
             # dep need commit to db because sync user need use it
@@ -85,17 +101,23 @@ class Department(models.Model):
             else:
                 dep.write(modify_data)
 
-            await self.env['hr.employee'].sync_ding_user(dep, dep_detail['dept_id'])
+            await self.env['hr.employee'].sync_ding_user(dep, dep_detail['dept_id'], seen_unionids)
+            return dep
 
-            if len(_dep_leaf['children']) > 0:
-                for child in _dep_leaf['children']:
-                    _tasks.append(_sync_dep(child, dep.id))
-                await asyncio.gather(*_tasks)
+        # sync level by level: a department only depends on its parent record, so
+        # every department of one level can run concurrently once the previous
+        # level is done, instead of being throttled by its own subtree shape
+        level = [(dep_leaf, False) for dep_leaf in depart_tree]
+        while level:
+            deps = await gather_all(*[_sync_dep(leaf, parent_id) for leaf, parent_id in level])
+            level = [(child, dep.id)
+                     for (leaf, _parent_id), dep in zip(level, deps)
+                     for child in leaf['children']]
 
-        for dep_leaf in depart_tree:
-            tasks.append(_sync_dep(dep_leaf, False))
-
-        await asyncio.gather(*tasks)
+        # deactivate only the employees that disappeared from dingtalk
+        self.env['hr.employee'].search(
+            [('ding_department_ids.ding_id', 'in', dep_ding_id_list),
+             ('ding_id', 'not in', list(seen_unionids))]).write({'active': False})
 
     @staticmethod
     def get_depart_info_by_ding_ids(app_key, app_secret, ding_ids):
@@ -106,23 +128,13 @@ class Department(models.Model):
         :param ding_ids:
         :return: info list
         """
-        department_infos = []
-
         ding_request = ding_request_instance(app_key, app_secret)
-        tasks = []
-
-        async def _add_wait(id):
-            dept_info = await ding_request.department_detail(id)
-            department_infos.append(dept_info)
 
-        for ding_id in ding_ids:
-            tasks.append(_add_wait(ding_id))
+        async def _details():
+            return await gather_all(
+                *[limit_api(ding_request.department_detail(ding_id)) for ding_id in ding_ids])
 
-        loop = asyncio.new_event_loop()
-        asyncio.set_event_loop(loop)
-        loop.run_until_complete(asyncio.gather(*tasks))
-        loop.close()
-        return department_infos
+        return run_async(_details())
 
     def get_main_manager_by_user_ding_ids(self, ding_ids, company_id):
         """
@@ -136,16 +148,44 @@ class Department(models.Model):
             [('ding_userid', '=', manager_user_id), ('company_id', '=', company_id)])
         return manager
 
+    def get_main_managers_by_user_ding_ids(self, department_infos, company_id):
+        """
+        batched variant of get_main_manager_by_user_ding_ids: one employee search
+        covers the first manager of every department info
+        :param department_infos: dingtalk department detail dicts
+        :param company_id:
+        :return: dict mapping dept_id to hr.employee record, empty when unknown
+        """
+        manager_user_ids = {dept['dept_manager_userid_list'][0]
+                            for dept in department_infos if dept['dept_manager_userid_list']}
+        managers = {
+            employee.ding_userid: employee
+            for employee in self.env['hr.employee'].search(
+                [('ding_userid', 'in', list(manager_user_ids)), ('company_id', '=', company_id)])
+        }
+        empty = self.env['hr.employee'].browse()
+        return {
+            dept['dept_id']: managers.get(
+                dept['dept_manager_userid_list'][0] if dept['dept_manager_userid_list'] else None, empty)
+            for dept in department_infos
+        }
+
     def on_ding_org_dept_create(self, content, app):
         department_infos = self.get_depart_info_by_ding_ids(app.app_key, app.app_secret, content['DeptId'])
-        self.env = api.Environment(self._cr, SUPERUSER_ID, {})
+        self = self.sudo()
+
+        # resolve every parent in one query and create all departments at once
+        parent_dids = {str(dept['parent_id']) for dept in department_infos if dept.get('parent_id', None) is not None}
+        parent_map = {dep.ding_id: dep for dep in self.search([('ding_id', 'in', list(parent_dids))])}
+        manager_map = self.get_main_managers_by_user_ding_ids(department_infos, app.company_id.id)
 
+        vals = []
         for dept in department_infos:
-            manager = self.get_main_manager_by_user_ding_ids(dept['dept_manager_userid_list'], app.company_id.id)
+            manager = manager_map[dept['dept_id']]
 
             parent_id = dept.get('parent_id', None)  # root department has no parent_id
-            parent_department = self.search([('ding_id', '=', parent_id)])
-            self.create({
+            parent_department = parent_map.get(str(parent_id), self.browse())
+            vals.append({
                 'company_id': app.company_id.id,
                 'ding_id': dept['dept_id'],
                 'name': dept['name'],
@@ -154,6 +194,8 @@ class Department(models.Model):
                 'ding_order': dept['order'],
                 'manager_id': manager.id
             })
+        if vals:
+            self.create(vals)
 
     def on_ding_org_dept_modify(self, content, app):
         """
@@ -163,14 +205,20 @@ class Department(models.Model):
         :return:
         """
         department_infos = self.get_depart_info_by_ding_ids(app.app_key, app.app_secret, content['DeptId'])
-        self.env = api.Environment(self._cr, SUPERUSER_ID, {})
+        self = self.sudo()
+
+        # one query covers both the modified departments and their parents
+        dept_dids = {str(dept['dept_id']) for dept in department_infos}
+        parent_dids = {str(dept['parent_id']) for dept in department_infos if dept.get('parent_id', None) is not None}
+        dept_map = {dep.ding_id: dep for dep in self.search([('ding_id', 'in', list(dept_dids | parent_dids))])}
+        manager_map = self.get_main_managers_by_user_ding_ids(department_infos, app.company_id.id)
 
         for dept in department_infos:
-            manager = self.get_main_manager_by_user_ding_ids(dept['dept_manager_userid_list'], app.company_id.id)
+            manager = manager_map[dept['dept_id']]
 
-            department = self.search([('ding_id', '=', dept['dept_id'])])
+            department = dept_map.get(str(dept['dept_id']))
             parent_id = dept.get('parent_id', None)  # root department has no parent_id
-            parent_department = self.search([('ding_id', '=', parent_id)])
+            parent_department = dept_map.get(str(parent_id), self.browse())
             if department:
                 department.write({
                     'name': dept['name'],
@@ -181,7 +229,7 @@ class Department(models.Model):
                 })
 
     def on_ding_org_dept_remove(self, content, app):
-        self.env = api.Environment(self._cr, SUPERUSER_ID, {})
+        self = self.sudo()
 
         self.search(
             [('ding_id', 'in', content['DeptId']), ('company_id', '=', app.company_id.id)]
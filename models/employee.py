@@ -1,8 +1,7 @@
-import asyncio
-
-from odoo import models, fields, api, SUPERUSER_ID
+from odoo import models, fields, api
 
 from ..common.ding_request import ding_request_instance
+from ..common.utils import gather_all, limit_api, run_async
 
 
 class Employee(models.Model):
@@ -38,19 +37,30 @@ class Employee(models.Model):
         self.write(val)
 
     def ding_create_with_user(self, val_list):
+        # one search for every login and one create for the missing users,
+        # instead of a search and possible create per employee
+        logins = [val['ding_id'] for val in val_list]
+        users = {
+            user.login: user
+            for user in self.env['res.users'].sudo().search(
+                [('login', 'in', logins), ('active', 'in', [True, False])])
+        }
+        group_user_id = self.env.ref('base.group_user').id
+
+        missing_vals = [{
+            'name': val['name'],
+            'login': val['ding_id'],
+            'company_id': val['company_id'],
+            'company_ids': [(4, val['company_id'])],
+            'groups_id': [(6, 0, [group_user_id])],
+            'active': val['active']
+        } for val in val_list if val['ding_id'] not in users]
+        if missing_vals:
+            for user in self.env['res.users'].sudo().create(missing_vals):
+                users[user.login] = user
+
         for val in val_list:
-            user = self.env['res.users'].sudo().search(
-                [('login', '=', val['ding_id']), ('active', 'in', [True, False])])
-            if user.id is False:
-                user = self.env['res.users'].sudo().create({
-                    'name': val['name'],
-                    'login': val['ding_id'],
-                    'company_id': val['company_id'],
-                    'company_ids': [(4, val['company_id'])],
-                    'groups_id': [(6, 0, [self.env.ref('base.group_user').id])],
-                    'active': val['active']
-                })
-            val['user_id'] = user.id
+            val['user_id'] = users[val['ding_id']].id
         return self.create(val_list)
 
     def get_employee_job(self, job_name, company_id):
@@ -63,33 +73,78 @@ class Employee(models.Model):
             })
         return job
 
-    async def sync_ding_user(self, ding_department, server_dep_id):
+    def get_employee_jobs_bulk(self, job_names, company_id):
+        """
+        resolve many job names at once: one search for all names and one create
+        for the missing ones, instead of a search (and possible create) per user
+        :param job_names: iterable of job names, falsy entries are skipped
+        :param company_id:
+        :return: dict mapping job name to hr.job record
+        """
+        names = {name for name in job_names if name}
+        jobs = {
+            job.name: job
+            for job in self.env['hr.job'].sudo().search(
+                [('name', 'in', list(names)), ('company_id', '=', company_id)])
+        }
+        missing = [name for name in names if name not in jobs]
+        if missing:
+            for job in self.env['hr.job'].sudo().create(
+                    [{'name': name, 'company_id': company_id} for name in missing]):
+                jobs[job.name] = job
+        return jobs
+
+    async def sync_ding_user(self, ding_department, server_dep_id, seen_unionids=None):
+        """
+        sync the users of one department
+        :param ding_department: hr.department record being synced
+        :param server_dep_id: dingtalk department id
+        :param seen_unionids: optional set collecting every unionid seen, so the
+        caller can deactivate the employees that disappeared from dingtalk
+        :return:
+        """
         ding_request = self.env.context.get('ding_request')
         ding_app = self.env.context.get('ding_app')
         sync_with_user = ding_app.sync_with_user
 
-        users = await ding_request.department_users(server_dep_id)
-        # users has multipage, so we need get all users
-        next_cursor = users.get('next_cursor', None)
-
-        user_list = users['list']
-        while next_cursor is not None:
-            _users = await ding_request.department_users(server_dep_id, cursor=next_cursor)
-            next_cursor = _users.get('next_cursor', None)
-            user_list.extend(_users['list'])
+        # users has multipage; department_users_all fetches the pages in
+        # concurrent waves instead of walking next_cursor sequentially
+        user_list = await ding_request.department_users_all(server_dep_id)
+
+        # resolve every employee and main department in one query each instead of
+        # one search per user; ding_id is a Char field, so dingtalk's numeric
+        # department ids are normalized to str for the lookup keys
+        unionids = [user['unionid'] for user in user_list]
+        if seen_unionids is not None:
+            seen_unionids.update(unionids)
+        # the department being synced is usually the main department, no need to
+        # search for it again
+        main_dep_ding_ids = {str(user['dept_id_list'][0]) for user in user_list} - {ding_department.ding_id}
+        employee_map = {
+            employee.ding_id: employee
+            for employee in self.search([('ding_id', 'in', unionids), ('active', 'in', [True, False])])
+        }
+        dept_map = {
+            dep.ding_id: dep
+            for dep in ding_department.search([('ding_id', 'in', list(main_dep_ding_ids))])
+        }
+        job_map = self.get_employee_jobs_bulk(
+            (user.get('title', None) for user in user_list), ding_app.company_id.id)
 
         create_users = []
         manager_id = None
 
         for user in user_list:
             # job
-            job = self.get_employee_job(user.get('title', None), ding_app.company_id.id)
+            job = job_map.get(user.get('title', None), self.env['hr.job'].browse())
 
             user_id = user['userid']
             unionid = user['unionid']
 
-            employee = self.search([('ding_id', '=', unionid), ('active', 'in', [True, False])])
-            main_department = ding_department.search([('ding_id', '=', user['dept_id_list'][0])])
+            employee = employee_map.get(unionid, self.browse())
+            main_dep_ding_id = str(user['dept_id_list'][0])
+            main_department = ding_department if main_dep_ding_id == ding_department.ding_id \
+                else dept_map.get(main_dep_ding_id, ding_department.browse())
 
             modify_data = {
                 'name': user['name'],
@@ -117,12 +172,13 @@ class Employee(models.Model):
                 manager_id = unionid
 
         if len(create_users) > 0:
-            # create users limit 500
-            limit = 500
-            for i in range(0, len(create_users), limit):
-                create_vals = create_users[i:i + limit]
-                # if config set not sync user, not create user
-                self.ding_create_with_user(create_vals) if sync_with_user else self.create(create_vals)
+            # mail subscriptions and tracking dominate bulk employee creation,
+            # so disable them and create the whole batch in one call instead of
+            # chunking by 500
+            batch = self.with_context(tracking_disable=True, mail_create_nolog=True,
+                                      mail_create_nosubscribe=True)
+            # if config set not sync user, not create user
+            batch.ding_create_with_user(create_users) if sync_with_user else batch.create(create_users)
         if manager_id:
             ding_department.write({'manager_id': self.search([('ding_id', '=', manager_id)]).id})
 
@@ -135,23 +191,13 @@ class Employee(models.Model):
         :param ding_ids:
         :return: info list
         """
-        user_infos = []
-
         ding_request = ding_request_instance(app_key, app_secret)
-        tasks = []
-
-        async def _add_wait(id):
-            user_info = await ding_request.get_user_info_by_userid(id)
-            user_infos.append(user_info)
 
-        for ding_id in ding_ids:
-            tasks.append(_add_wait(ding_id))
+        async def _infos():
+            return await gather_all(
+                *[limit_api(ding_request.get_user_info_by_userid(ding_id)) for ding_id in ding_ids])
 
-        loop = asyncio.new_event_loop()
-        asyncio.set_event_loop(loop)
-        loop.run_until_complete(asyncio.gather(*tasks))
-        loop.close()
-        return user_infos
+        return run_async(_infos())
 
     def on_ding_user_add_org(self, content, app):
         """
@@ -161,13 +207,21 @@ class Employee(models.Model):
         :return:
         """
         user_infos = self.get_user_info_by_ding_ids(app.app_key, app.app_secret, content['UserId'])
-        self.env = api.Environment(self._cr, SUPERUSER_ID, {})
+        self = self.sudo()
 
         for user in user_infos:
             unionid = user['unionid']
             job = self.get_employee_job(user.get('title', None), app.company_id.id)
-            main_department = self.env['hr.department'].search([('ding_id', '=', user['dept_id_list'][0])])
-            departments = self.env['hr.department'].search([('ding_id', 'in', user['dept_id_list'])])
+            # one search covering the user's departments and the ones they lead,
+            # then in-python filtering instead of a query per subset
+            dept_ding_ids = {str(i) for i in user['dept_id_list']}
+            leader_ding_ids = {str(i['dept_id']) for i in user['leader_in_dept'] if i['leader'] is True}
+            depts = self.env['hr.department'].search(
+                [('ding_id', 'in', list(dept_ding_ids | leader_ding_ids))])
+            dept_by_ding_id = {dep.ding_id: dep for dep in depts}
+            main_department = dept_by_ding_id.get(str(user['dept_id_list'][0]),
+                                                  self.env['hr.department'].browse())
+            departments = depts.filtered(lambda dep: dep.ding_id in dept_ding_ids)
 
             employee = self.create({
                 'name': user['name'],
@@ -184,11 +238,10 @@ class Employee(models.Model):
                 'marital': False,
                 'active': user['active']
             })
-            leader_dep_ding_ids = [i['dept_id'] for i in user['leader_in_dept'] if i['leader'] is True]
-            # set new department manager if leader_dep_ding_ids is not empty
-            if len(leader_dep_ding_ids) > 0:
-                self.env['hr.department'].search([('ding_id', 'in', leader_dep_ding_ids)]).write(
-                    {'manager_id': employee.id})
+            # set new department manager if leader_ding_ids is not empty
+            leader_depts = depts.filtered(lambda dep: dep.ding_id in leader_ding_ids)
+            if leader_depts:
+                leader_depts.write({'manager_id': employee.id})
 
     def on_ding_user_modify_org(self, content, app):
         """
@@ -198,14 +251,22 @@ class Employee(models.Model):
         :return:
         """
         user_infos = self.get_user_info_by_ding_ids(app.app_key, app.app_secret, content['UserId'])
-        self.env = api.Environment(self._cr, SUPERUSER_ID, {})
+        self = self.sudo()
 
         for user in user_infos:
             unionid = user['unionid']
             job = self.get_employee_job(user.get('title', None), app.company_id.id)
             employee = self.search([('ding_id', '=', unionid), ('active', 'in', [True, False])])
-            main_department = self.env['hr.department'].search([('ding_id', '=', user['dept_id_list'][0])])
-            departments = self.env['hr.department'].search([('ding_id', 'in', user['dept_id_list'])])
+            # one search covering the user's departments and the ones they lead,
+            # then in-python filtering instead of a query per subset
+            dept_ding_ids = {str(i) for i in user['dept_id_list']}
+            leader_ding_ids = {str(i['dept_id']) for i in user['leader_in_dept'] if i['leader'] is True}
+            depts = self.env['hr.department'].search(
+                [('ding_id', 'in', list(dept_ding_ids | leader_ding_ids))])
+            dept_by_ding_id = {dep.ding_id: dep for dep in depts}
+            main_department = dept_by_ding_id.get(str(user['dept_id_list'][0]),
+                                                  self.env['hr.department'].browse())
+            departments = depts.filtered(lambda dep: dep.ding_id in dept_ding_ids)
 
             if employee.id is not False:
                 employee.write({
@@ -227,11 +288,13 @@ class Employee(models.Model):
                         'name': user['name'],
                         'active': user['active']
                     })
-                leader_dep_ding_ids = [i['dept_id'] for i in user['leader_in_dept'] if i['leader'] is True]
-                # clear department manager and then set new department manager
-                self.env['hr.department'].search([('manager_id', '=', employee.id)]).write({'manager_id': False})
-                self.env['hr.department'].search([('ding_id', 'in', leader_dep_ding_ids)]).write(
-                    {'manager_id': employee.id})
+                # write only the real manager changes: departments that keep the
+                # employee as manager are left untouched instead of being cleared
+                # and immediately re-set
+                current_depts = self.env['hr.department'].search([('manager_id', '=', employee.id)])
+                new_depts = depts.filtered(lambda dep: dep.ding_id in leader_ding_ids)
+                (current_depts - new_depts).write({'manager_id': False})
+                (new_depts - current_depts).write({'manager_id': employee.id})
 
     def on_ding_user_leave_org(self, content, app):
         """
@@ -240,7 +303,7 @@ class Employee(models.Model):
         :param app:
         :return:
         """
-        self.env = api.Environment(self._cr, SUPERUSER_ID, {})
+        self = self.sudo()
 
         self.search(
             [('ding_id', 'in', content['UserId']), ('active', 'in', [True, False]),
@@ -254,7 +317,7 @@ class Employee(models.Model):
         :param app:
         :return:
         """
-        self.env = api.Environment(self._cr, SUPERUSER_ID, {})
+        self = self.sudo()
 
         self.search(
             [('ding_id', 'in', content['UserId']), ('active', 'in', [True, False]),